@@ -1,60 +1,124 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 from datetime import datetime
+import matplotlib
+# Backend no interactivo: evita cargar Tk/Qt solo para guardar el gráfico
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from fpdf import FPDF
 from io import BytesIO
 import os
+import pathlib
 import re
 import textwrap
+import time
 import traceback
 from PIL import Image
 import unicodedata
 import argparse
-import chardet
+import functools
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+import types
+
+# Preferir un detector de codificación en C si está disponible. _detector es el
+# detector incremental reutilizable para mensajes grandes del mismo backend
+# (charset_normalizer no tiene uno, así que siempre usa la detección completa)
+try:
+    import cchardet as _cd
+    _detector = _cd.UniversalDetector()
+except ImportError:
+    try:
+        from charset_normalizer import detect as _detect
+        _cd = types.SimpleNamespace(detect=_detect)
+        _detector = None
+    except ImportError:
+        import chardet as _cd
+        _detector = _cd.UniversalDetector()
 
 # ====================== FUNCIONES AUXILIARES ======================
+# Tabla de traducción de ñ y tildes a su equivalente ASCII
+_TRANS = str.maketrans({
+    'ñ': 'n', 'Ñ': 'N',
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+    'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+})
+# Caracteres fuera del rango ASCII imprimible
+_STRIP = re.compile(r'[^\x20-\x7e]')
+# Patrones usados al limpiar nombres de contacto
+_RE_SEMIS = re.compile(r'[;]{2,}')
+_RE_WS = re.compile(r'\s+')
+# Cualquier byte que no sea de control ni espacio (si no hay ninguno, el mensaje queda vacío)
+_RE_VISIBLE_BYTE = re.compile(rb'[^\x00-\x20\x7f]')
+# Ordinal del 1970-01-01, para convertir días desde epoch en ordinales de fecha
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
 def safe_string(text):
     """Convierte texto a ASCII seguro manteniendo ñ y tildes simplificadas"""
     if not text:
         return ""
     
-    try:
-        # Conservar ñ y Ñ
-        text = text.replace('ñ', 'n').replace('Ñ', 'N')
-        text = text.replace('á', 'a').replace('é', 'e').replace('í', 'i').replace('ó', 'o').replace('ú', 'u')
-        text = text.replace('Á', 'A').replace('É', 'E').replace('Í', 'I').replace('Ó', 'O').replace('Ú', 'U')
-        
-        # Filtrar caracteres
-        text = ''.join(c for c in text if 32 <= ord(c) <= 126 or c in 'ñÑáéíóúÁÉÍÓÚ')
-        return text
-    except:
-        return "[Texto no válido]"
+    return _STRIP.sub('', text.translate(_TRANS))
+
+_EMPTY_MSG = safe_string("[Mensaje vacio]")
+
+@functools.lru_cache(maxsize=8192)
+def safe_string_cached(text):
+    """Versión cacheada de safe_string para textos cortos y repetidos (nombres, etiquetas)"""
+    return safe_string(text)
 
 def clean_contact_name(name):
     """Limpia nombres de contacto"""
     if not name:
         return "Contacto Desconocido"
     
-    name = re.sub(r'[;]{2,}', '', name)
-    name = re.sub(r'\s+', ' ', name).strip()
-    name = safe_string(name)
+    name = _RE_SEMIS.sub('', name)
+    name = _RE_WS.sub(' ', name).strip()
+    name = safe_string_cached(name)
     
     if len(name) > 50:
         name = name[:47] + "..."
     
     return name
 
+def detect_encoding(data):
+    """Detecta la codificación, alimentando el detector por bloques en mensajes grandes"""
+    if _detector is None or len(data) <= 4096:
+        return _cd.detect(data)
+    
+    _detector.reset()
+    view = memoryview(data)
+    for i in range(0, len(data), 2048):
+        _detector.feed(bytes(view[i:i + 2048]))
+        if _detector.done:
+            break
+    _detector.close()
+    return _detector.result
+
 def decode_message_data(data):
     """Decodifica datos binarios de mensajes de Telegram"""
-    if data is None:
+    if not data:
+        return ""
+    
+    # Mensajes de servicio sin texto: evitar decodificar y detectar codificación
+    if isinstance(data, bytes) and not _RE_VISIBLE_BYTE.search(data):
         return ""
     
     try:
         # Detectar la codificación automáticamente
         if isinstance(data, bytes):
-            result = chardet.detect(data)
-            encoding = result['encoding'] if result['confidence'] > 0.7 else 'utf-8'
+            # Caso rápido: la mayoría de mensajes ya son ASCII o UTF-8 válido
+            if data.isascii():
+                return data.decode('ascii')
+            try:
+                return data.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            
+            result = detect_encoding(data)
+            encoding = result['encoding'] if (result['confidence'] or 0) > 0.7 else 'utf-8'
             
             # Intentar decodificar con la codificación detectada
             try:
@@ -70,104 +134,115 @@ def decode_message_data(data):
     except Exception as e:
         return f"[Error decodificando mensaje: {str(e)}]"
 
-def get_chat_name(conn, uid):
-    if uid in get_chat_name.cache:
-        return get_chat_name.cache[uid]
+def load_chat_names(conn):
+    """Carga de una sola vez los nombres de usuarios, chats y contactos por uid"""
+    queries = [
+        "SELECT uid, name FROM users",
+        "SELECT uid, name FROM chats",
+        "SELECT uid, name FROM enc_chats",
+        "SELECT uid, fname || ' ' || sname FROM user_contacts_v7",
+    ]
     
-    name = "Contacto Desconocido"
-    try:
-        queries = [
-            ("SELECT name FROM users WHERE uid = ?", [abs(uid)]),
-            ("SELECT name FROM chats WHERE uid = ?", [abs(uid)]),
-            ("SELECT name FROM enc_chats WHERE uid = ?", [abs(uid)]),
-            ("SELECT fname || ' ' || sname AS name FROM user_contacts_v7 WHERE uid = ?", [abs(uid)]),
-        ]
-        
-        cursor = conn.cursor()
-        for query, params in queries:
-            try:
-                cursor.execute(query, params)
-                result = cursor.fetchone()
-                if result and result[0]:
-                    name = result[0]
-                    break
-            except:
-                continue
-        
-        if name == "Contacto Desconocido":
-            name = f"Contacto {uid}"
-    except:
-        name = f"Contacto {uid}"
+    names = {}
+    cursor = conn.cursor()
+    for query in queries:
+        try:
+            for uid, name in cursor.execute(query):
+                # Las primeras tablas tienen prioridad sobre las siguientes
+                if name:
+                    names.setdefault(uid, name)
+        except sqlite3.OperationalError:
+            continue
     
-    get_chat_name.cache[uid] = name
-    return name
+    return names
 
-get_chat_name.cache = {}
+def make_chat_name_lookup(names):
+    """Devuelve una función que resuelve el nombre ya limpio de un chat a partir de su uid"""
+    cache = {}
+    
+    def get_chat_name(uid):
+        if uid in cache:
+            return cache[uid]
+        
+        name = names.get(abs(uid))
+        name = clean_contact_name(name if name else f"Contacto {uid}")
+        cache[uid] = name
+        return name
+    
+    return get_chat_name
 
-def group_messages_by_contact_and_date(messages, conn):
-    """Agrupa mensajes por contacto y luego por fecha"""
-    conversations = {}
+def group_messages_by_contact_and_date(conn, get_chat_name):
+    """Agrupa mensajes por contacto y luego por fecha
+    
+    Los contactos se recorren en orden alfabético y los mensajes de cada uno se
+    leen con su propia consulta ordenada por fecha, de modo que SQLite solo
+    ordena (como mucho) una conversación cada vez. Genera las conversaciones de
+    una en una para no mantener todas en memoria.
+    """
+    # Los uids que comparten nombre se muestran como una sola conversación
+    contacts = defaultdict(list)
+    for (uid,) in conn.execute("SELECT DISTINCT uid FROM messages_v2"):
+        contacts[get_chat_name(uid)].append(uid)
     
-    for row in messages:
+    # Referencias locales para el bucle por fila (evita búsquedas de globales y atributos)
+    _localtime = time.localtime
+    _strftime = time.strftime
+    _decode = decode_message_data
+    _safe = safe_string
+    _empty_msg = _EMPTY_MSG
+    _epoch_ordinal = _EPOCH_ORDINAL
+    _fmt_time = '%H:%M:%S'
+    
+    def parse_row(row):
+        """Convierte una fila de messages_v2 en una tupla (día, mensaje)"""
         mid, uid, date_ts, out, data = row
-        chat_name = clean_contact_name(get_chat_name(conn, uid))
         
+        # Día como ordinal entero (0 = fecha desconocida); la cadena se genera al agrupar
         if date_ts > 0:
-            date_obj = datetime.fromtimestamp(date_ts)
-            date_str = date_obj.strftime('%Y-%m-%d')
+            local_time = _localtime(date_ts)
+            day = (date_ts + local_time.tm_gmtoff) // 86400 + _epoch_ordinal
+            timestamp = _strftime(_fmt_time, local_time)
         else:
-            date_str = "Fecha desconocida"
-        
-        if chat_name not in conversations:
-            conversations[chat_name] = {}
-        
-        if date_str not in conversations[chat_name]:
-            conversations[chat_name][date_str] = []
-        
-        timestamp = datetime.fromtimestamp(date_ts).strftime('%H:%M:%S') if date_ts > 0 else "Hora desconocida"
+            day = 0
+            timestamp = "Hora desconocida"
         
         # Decodificar el mensaje correctamente
-        message_text = decode_message_data(data)
-        message_text = safe_string(message_text)
+        message_text = _decode(data)
+        message_text = _safe(message_text) if message_text else _empty_msg
         
         # CORRECCIÓN: Invertir la dirección de los mensajes
         is_outgoing = out == 1
         
-        conversations[chat_name][date_str].append({
+        return day, {
             'timestamp': timestamp,
             'is_outgoing': is_outgoing,
             'text': message_text,
             'raw_timestamp': date_ts
-        })
-    
-    for contact in conversations:
-        for date_str in conversations[contact]:
-            conversations[contact][date_str].sort(key=lambda x: x['raw_timestamp'])
-    
-    sorted_contacts = sorted(conversations.keys())
+        }
     
-    result = []
-    for contact in sorted_contacts:
+    day_key = itemgetter(0)
+    for contact in sorted(contacts):
+        uids = contacts[contact]
+        # Con un solo uid el índice (uid, date, mid) de Telegram ya da el orden sin ordenar
+        contact_rows = conn.execute(f"""
+            SELECT m.mid, m.uid, m.date, m.out, m.data
+            FROM messages_v2 m
+            WHERE m.uid IN ({', '.join('?' * len(uids))})
+            ORDER BY m.date, m.mid
+        """, uids)
+        
         contact_data = {
             'contact': contact,
             'dates': []
         }
         
-        # Ordenar fechas de más antiguas a más recientes
-        sorted_dates = sorted(
-            conversations[contact].items(), 
-            key=lambda x: datetime.strptime(x[0], '%Y-%m-%d') if x[0] != "Fecha desconocida" else datetime.min
-        )
-        
-        for date_str, messages in sorted_dates:
+        for day, day_items in groupby(map(parse_row, contact_rows), key=day_key):
             contact_data['dates'].append({
-                'date': date_str,
-                'messages': messages
+                'date': datetime.fromordinal(day).strftime('%Y-%m-%d') if day else "Fecha desconocida",
+                'messages': [message for _, message in day_items]
             })
         
-        result.append(contact_data)
-    
-    return result
+        yield contact_data
 
 # ====================== CLASES PRINCIPALES ======================
 class PDFReport(FPDF):
@@ -191,29 +266,29 @@ class PDFReport(FPDF):
     def add_section_title(self, title):
         self.set_font('Helvetica', 'B', 12)
         self.set_fill_color(240, 240, 240)
-        self.cell(0, 8, safe_string(title), 0, 1, 'L', 1)
+        self.cell(0, 8, safe_string_cached(title), 0, 1, 'L', 1)
         self.ln(2)
     
     def add_conversation_header(self, chat_name):
         self.set_font('Helvetica', 'B', 11)
         self.set_fill_color(200, 220, 255)
-        self.cell(0, 8, safe_string(f"Conversacion con: {chat_name}"), 0, 1, 'L', 1)
+        self.cell(0, 8, safe_string_cached(f"Conversacion con: {chat_name}"), 0, 1, 'L', 1)
         self.ln(2)
     
     def add_date_header(self, date):
         self.set_font('Helvetica', '', 10)
         self.set_fill_color(230, 230, 230)
-        self.cell(0, 6, safe_string(f"Fecha: {date}"), 0, 1, 'L', 1)
+        self.cell(0, 6, safe_string_cached(f"Fecha: {date}"), 0, 1, 'L', 1)
         self.ln(1)
     
     def add_message(self, direction, contact, time, message):
         # Asegurarse que el mensaje no esté vacío
         if not message.strip():
-            message = "[Mensaje vacio]"
+            message = _EMPTY_MSG
         
         self.set_font('Helvetica', 'B', 9)
         self.set_text_color(50, 50, 50)
-        header_text = safe_string(f"{direction} {contact} | {time}")
+        header_text = f"{safe_string_cached(f'{direction} {contact}')} | {safe_string(time)}"
         self.cell(0, 5, header_text, 0, 1)
         
         self.set_font('Helvetica', '', 10)
@@ -236,7 +311,17 @@ def generate_telegram_report(db_path, pdf_path):
     conn = None
     
     try:
-        conn = sqlite3.connect(db_path)
+        # Abrir en solo lectura: no se modifica la evidencia y se evita el sondeo de journal
+        db_uri = pathlib.Path(db_path).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(db_uri, uri=True)
+        for pragma in (
+            "PRAGMA query_only=1",
+            "PRAGMA mmap_size=268435456",
+            "PRAGMA cache_size=-131072",
+            "PRAGMA temp_store=MEMORY",
+            "PRAGMA synchronous=OFF",
+        ):
+            conn.execute(pragma)
         pdf = PDFReport()
         
         pdf.add_page()
@@ -294,39 +379,35 @@ def generate_telegram_report(db_path, pdf_path):
         pdf.add_page()
         pdf.add_section_title("Mensajes Recientes")
         
+        num_messages = 0
+        
         try:
             print("Extrayendo y agrupando mensajes...")
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT m.mid, m.uid, m.date, m.out, m.data
-                FROM messages_v2 m
-                ORDER BY m.date DESC
-            """)
-            messages = cursor.fetchall()
+            get_chat_name = make_chat_name_lookup(load_chat_names(conn))
             
-            if messages:
-                conversations = group_messages_by_contact_and_date(messages, conn)
+            # Cada conversación se escribe en el PDF en cuanto se cierra y se libera
+            for contact_data in group_messages_by_contact_and_date(conn, get_chat_name):
+                pdf.add_conversation_header(contact_data['contact'])
                 
-                for contact_data in conversations:
-                    pdf.add_conversation_header(contact_data['contact'])
+                for date_data in contact_data['dates']:
+                    pdf.add_date_header(date_data['date'])
                     
-                    for date_data in contact_data['dates']:
-                        pdf.add_date_header(date_data['date'])
+                    for message in date_data['messages']:
+                        num_messages += 1
+                        direction = "Para" if message['is_outgoing'] else "Desde"
                         
-                        for message in date_data['messages']:
-                            direction = "Para" if message['is_outgoing'] else "Desde"
-                            
-                            message_text = message['text']
-                            
-                            pdf.add_message(
-                                direction=direction,
-                                contact=contact_data['contact'],
-                                time=message['timestamp'],
-                                message=message_text
-                            )
-                    
-                    pdf.ln(8)
-            else:
+                        message_text = message['text']
+                        
+                        pdf.add_message(
+                            direction=direction,
+                            contact=contact_data['contact'],
+                            time=message['timestamp'],
+                            message=message_text
+                        )
+                
+                pdf.ln(8)
+            
+            if not num_messages:
                 pdf.multi_cell(0, 6, safe_string("No se encontraron mensajes en la base de datos."))
                 print("No se encontraron mensajes en la base de datos.")
         except Exception as e:
@@ -342,13 +423,23 @@ def generate_telegram_report(db_path, pdf_path):
         try:
             print("Generando estadísticas de actividad...")
             cursor = conn.cursor()
-            cursor.execute("SELECT date FROM messages_v2 WHERE date > 0")
+            # Histograma por hora calculado directamente en SQLite (hora local, como fromtimestamp).
+            # strftime devuelve NULL para fechas que no puede interpretar; esas filas se descartan
+            cursor.execute("""
+                SELECT CAST(strftime('%H', date, 'unixepoch', 'localtime') AS INT) AS h, COUNT(*)
+                FROM messages_v2
+                WHERE date > 0
+                GROUP BY h
+                HAVING h IS NOT NULL
+            """)
             timeline = cursor.fetchall()
             
             if timeline:
-                dates = [datetime.fromtimestamp(row[0]) for row in timeline]
-                hours = [d.hour for d in dates]
-                hour_counts = pd.Series(hours).value_counts().sort_index()
+                # Vector fijo de 24 horas (las horas sin mensajes quedan a 0)
+                counts = np.zeros(24, dtype=np.int64)
+                for hour, total in timeline:
+                    counts[hour] = total
+                hour_counts = pd.Series(counts, index=range(24))
                 
                 plt.figure(figsize=(10, 4))
                 hour_counts.plot(kind='bar', color='skyblue')
@@ -359,10 +450,10 @@ def generate_telegram_report(db_path, pdf_path):
                 plt.tight_layout()
                 
                 img_path = 'activity_chart.png'
-                plt.savefig(img_path)
+                plt.savefig(img_path, format='png', dpi=90)
                 plt.close()
                 
-                pdf.image(img_path, x=10, w=pdf.w - 20)
+                pdf.image(img_path, x=10, w=pdf.w - 20, type='PNG')
                 os.remove(img_path)
             else:
                 pdf.multi_cell(0, 6, safe_string("No hay datos para generar gráfico de actividad."))
@@ -407,8 +498,6 @@ def generate_telegram_report(db_path, pdf_path):
         
         pdf.set_font('Helvetica', '', 10)
         
-        num_messages = len(messages) if messages else 0
-        
         peak_hour = "N/A"
         if 'hour_counts' in locals() and not hour_counts.empty:
             try: